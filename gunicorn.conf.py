@@ -0,0 +1,23 @@
+import os
+from dotenv import load_dotenv
+
+# Same .env as middleware, so both see the same WEB_CONCURRENCY
+load_dotenv()
+
+# Production server: gunicorn -c gunicorn.conf.py middleware:app
+# Each worker starts its own STT process pool (and model copies), so default to
+# one worker and let threads absorb the I/O-bound webhook traffic. In-flight
+# voice note dedup is also per worker, so a redelivered webhook can be handled
+# twice when workers > 1
+bind = f"0.0.0.0:{os.getenv('PORT', 5000)}"
+workers = int(os.getenv('WEB_CONCURRENCY') or 1)
+worker_class = "gthread"
+threads = int(os.getenv('GUNICORN_THREADS') or 16)
+# Worker heartbeats go to tmpfs instead of disk
+worker_tmp_dir = "/dev/shm"
+
+def post_worker_init(worker):
+    # Pre-start the worker's STT pool and warm upstream connections once the
+    # app is loaded; middleware doesn't do this at import time
+    from middleware import start_background_services
+    start_background_services()
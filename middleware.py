@@ -1,20 +1,47 @@
 import os
 import requests
-import tempfile
-import speech_recognition as sr
-from pydub import AudioSegment
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.util.retry import Retry
+import atexit
+import hashlib
+import io
+import socket
+import threading
+from cachetools import LRUCache, TTLCache
 from flask import Flask, request, jsonify
+from flask.json.provider import JSONProvider
 from dotenv import load_dotenv
-import json
-from concurrent.futures import ThreadPoolExecutor
+import msgspec
+import orjson
+import logging
+import queue
+import random
+from logging.handlers import QueueHandler, QueueListener
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import time
+from types import MappingProxyType
+import stt
 
 # Load environment variables
 load_dotenv()
 
+class OrjsonProvider(JSONProvider):
+    # Routes request.get_json() and jsonify() through orjson
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj), mimetype="application/json")
+
 app = Flask(__name__)
-executor = ThreadPoolExecutor(max_workers=5)
-recognizer = sr.Recognizer()
+app.json = OrjsonProvider(app)
 
 # Config
 WHATSAPP_TOKEN = os.getenv('WHATSAPP_ACCESS_TOKEN')
@@ -23,6 +50,198 @@ WHATSAPP_PHONE_NUMBER_ID = os.getenv('WHATSAPP_PHONE_NUMBER_ID')
 BOTPRESS_WEBHOOK_URL = os.getenv('BOTPRESS_WEBHOOK_URL')
 BOTPRESS_BOT_ID = os.getenv('BOTPRESS_BOT_ID')
 BOTPRESS_TOKEN = os.getenv('BOTPRESS_TOKEN')
+STT_WORKERS = int(os.getenv('STT_WORKERS') or 2)
+# Every gunicorn worker runs its own STT pool; split the cores across all of them
+WEB_CONCURRENCY = int(os.getenv('WEB_CONCURRENCY') or 1)
+WHISPER_MODEL = os.getenv('WHISPER_MODEL') or 'small.en'
+WHISPER_COMPUTE_TYPE = os.getenv('WHISPER_COMPUTE_TYPE') or 'int8'
+WHISPER_CPU_THREADS = int(os.getenv('WHISPER_CPU_THREADS') or max(1, (os.cpu_count() or 2) // (WEB_CONCURRENCY * STT_WORKERS)))
+WHISPER_BATCH_SIZE = int(os.getenv('WHISPER_BATCH_SIZE') or 8)
+WHISPER_CHUNK_SECONDS = int(os.getenv('WHISPER_CHUNK_SECONDS') or 20)
+STT_MAX_QUEUE = int(os.getenv('STT_MAX_QUEUE') or 32)
+LOG_LEVEL = os.getenv('LOG_LEVEL') or 'INFO'
+
+# Outbound URLs and headers, built once instead of on every call
+# (Authorization lives on the per-host sessions below)
+GRAPH_API_URL = "https://graph.facebook.com/v18.0"
+WHATSAPP_MESSAGES_URL = f"{GRAPH_API_URL}/{WHATSAPP_PHONE_NUMBER_ID}/messages"
+BOTPRESS_CONVERSATIONS_URL = f"https://messaging.botpress.cloud/{BOTPRESS_BOT_ID}/conversations"
+# Read-only so no call site can mutate the shared header maps. A None value
+# removes the session's bearer token where it isn't needed.
+NO_AUTH_HEADERS = MappingProxyType({"Authorization": None})
+JSON_HEADERS = MappingProxyType({"Content-Type": "application/json"})
+BOTPRESS_WEBHOOK_HEADERS = MappingProxyType({"Content-Type": "application/json", "Authorization": None})
+
+# Logging: request threads only enqueue records, a listener thread formats
+# and writes them
+class DeferredQueueHandler(QueueHandler):
+    # Stock prepare() formats on the calling thread; hand the record over as-is
+    # so %-formatting (and LazyJSON) runs on the listener instead
+    def prepare(self, record):
+        return record
+
+log_queue = queue.SimpleQueue()
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+log_listener = QueueListener(log_queue, log_handler)
+log_listener.start()
+atexit.register(log_listener.stop)  # flush queued records on shutdown
+log = logging.getLogger("middleware")
+log.setLevel(LOG_LEVEL)
+log.addHandler(DeferredQueueHandler(log_queue))
+log.propagate = False
+
+class LazyJSON:
+    # Defers payload serialisation until a DEBUG record is actually formatted
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        if isinstance(self.obj, bytes):
+            return self.obj.decode(errors="replace")
+        return orjson.dumps(self.obj, option=orjson.OPT_INDENT_2).decode()
+
+VOICE_ACK_TEXT = "🎤 I received your voice message! Processing..."
+STT_UNAVAILABLE_TEXT = "Sorry, voice recognition service is unavailable."
+STT_BUSY_TEXT = "⏳ I'm handling a lot of voice messages right now, please try again in a minute."
+
+# WhatsApp webhook payload, decoded straight from the request bytes.
+# Only the fields we read are declared; msgspec skips everything else.
+class Text(msgspec.Struct):
+    body: str
+
+class Audio(msgspec.Struct):
+    id: str
+
+class Message(msgspec.Struct):
+    from_: str = msgspec.field(name="from")
+    type: str
+    text: Text | None = None
+    audio: Audio | None = None
+
+class Value(msgspec.Struct):
+    messages: list[Message] = []
+    statuses: list[msgspec.Raw] = []
+
+class Change(msgspec.Struct):
+    value: Value = msgspec.field(default_factory=Value)
+
+class Entry(msgspec.Struct):
+    changes: list[Change] = []
+
+class WebhookEvent(msgspec.Struct):
+    entry: list[Entry] = []
+
+webhook_event_decoder = msgspec.json.Decoder(WebhookEvent)
+
+# Outbound WhatsApp text message; only `to` and `text` vary per call
+class OutboundTextMessage(msgspec.Struct, kw_only=True):
+    messaging_product: str = "whatsapp"
+    recipient_type: str = "individual"
+    to: str
+    type: str = "text"
+    text: Text
+
+json_encoder = msgspec.json.Encoder()
+
+# Network I/O only (the GIL isn't the bottleneck), so size well past the core count
+executor = ThreadPoolExecutor(max_workers=min(32, 4 * (os.cpu_count() or 1)))
+# Media downloads are long socket reads; a separate pool keeps them from
+# queueing text relays, acks and Botpress forwards behind them. Also I/O-bound,
+# so it isn't tied to the STT worker count.
+media_executor = ThreadPoolExecutor(max_workers=min(32, 4 * (os.cpu_count() or 1)))
+
+# Speech-to-text runs in separate worker processes (see stt.py) so inference
+# isn't serialised by the GIL
+def make_stt_executor():
+    return ProcessPoolExecutor(
+        max_workers=STT_WORKERS,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=stt.init_stt_worker,
+        initargs=(WHISPER_MODEL, WHISPER_COMPUTE_TYPE, WHISPER_CPU_THREADS, WHISPER_BATCH_SIZE, WHISPER_CHUNK_SECONDS),
+    )
+
+stt_executor = make_stt_executor()
+stt_executor_lock = threading.Lock()
+# Cleared when a worker of the current pool dies, set again once a pool accepts
+# work; reported by /health
+stt_pool_ok = True
+
+def submit_stt(fn, *args):
+    # One dead worker (e.g. OOM on a long note) breaks the whole pool and every
+    # later submit raises BrokenProcessPool; swap in a fresh pool and retry once
+    global stt_executor, stt_pool_ok
+    with stt_executor_lock:
+        try:
+            future = stt_executor.submit(fn, *args)
+        except BrokenProcessPool:
+            log.warning("STT pool is broken, restarting it")
+            stt_executor.shutdown(wait=False)
+            stt_executor = make_stt_executor()
+            try:
+                future = stt_executor.submit(fn, *args)
+            except Exception:
+                stt_pool_ok = False
+                raise
+        stt_pool_ok = True
+        pool = stt_executor
+    future.add_done_callback(lambda f: note_stt_pool_health(pool, f))
+    return future
+
+def note_stt_pool_health(pool, future):
+    global stt_pool_ok
+    if not future.cancelled() and isinstance(future.exception(), BrokenProcessPool):
+        with stt_executor_lock:
+            if pool is stt_executor:
+                stt_pool_ok = False
+
+# Voice notes queued in or running on the STT pool; capped at STT_MAX_QUEUE so
+# a burst can't pile up unbounded work (and memory) behind the workers
+stt_pending = 0
+stt_pending_lock = threading.Lock()
+
+# Voice notes (by media id) between webhook dispatch and their Botpress send.
+# Per process: a redelivery routed to another gunicorn worker isn't caught.
+inflight_audio_ids = set()
+inflight_audio_lock = threading.Lock()
+
+# Transcripts keyed by a BLAKE2b-128 digest of the OGG bytes; WhatsApp
+# retries and forwarded voice notes skip inference entirely
+transcript_cache = LRUCache(maxsize=1024)
+transcript_cache_lock = threading.Lock()
+
+# Graph's signed media URLs stay valid for a few minutes, so a retried
+# media_id can skip the metadata lookup
+media_url_cache = TTLCache(maxsize=10_000, ttl=240)
+media_url_cache_lock = threading.Lock()
+
+# TCP keepalive so pooled connections survive idle gaps between bursts
+KEEPALIVE_SOCKET_OPTIONS = [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+for _name, _value in (("TCP_KEEPIDLE", 30), ("TCP_KEEPINTVL", 10), ("TCP_KEEPCNT", 3)):
+    if hasattr(socket, _name):
+        KEEPALIVE_SOCKET_OPTIONS.append((socket.IPPROTO_TCP, getattr(socket, _name), _value))
+
+class KeepAliveAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["socket_options"] = HTTPConnection.default_socket_options + KEEPALIVE_SOCKET_OPTIONS
+        super().init_poolmanager(*args, **kwargs)
+
+# One pooled session per upstream so keep-alive reuses TLS connections and
+# the bearer token is set once rather than per call
+def make_session(token):
+    session = requests.Session()
+    session.headers["Authorization"] = f"Bearer {token}"
+    adapter = KeepAliveAdapter(
+        pool_connections=10,
+        pool_maxsize=50,
+        max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504]),
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+wa_session = make_session(WHATSAPP_TOKEN)  # Graph API and media CDN
+bp_session = make_session(BOTPRESS_TOKEN)  # Botpress messaging and webhook
 
 # -------------------
 # WhatsApp → Middleware
@@ -36,55 +255,83 @@ def webhook():
         challenge = request.args.get('hub.challenge')
 
         if mode == 'subscribe' and token == WHATSAPP_VERIFY_TOKEN:
-            print("Webhook verified successfully")
+            log.info("Webhook verified successfully")
             return challenge
         else:
-            print("Webhook verification failed")
+            log.warning("Webhook verification failed")
             return 'Verification failed', 403
 
     elif request.method == 'POST':
-        data = request.get_json()
-        print(f"📩 Received WhatsApp event: {json.dumps(data, indent=2)}")
-
-        # Forward raw payload to Botpress webhook
+        raw = request.get_data(cache=False)
+        log.debug("📩 Received WhatsApp event: %s", LazyJSON(raw))
         try:
-            headers = {"Content-Type": "application/json"}
-            bp_response = requests.post(BOTPRESS_WEBHOOK_URL, json=data, headers=headers, timeout=5)
-            print(f"➡ Forwarded to Botpress, status: {bp_response.status_code}")
-        except Exception as e:
-            print(f"❌ Error forwarding to Botpress: {e}")
+            event = webhook_event_decoder.decode(raw)
+        except msgspec.ValidationError as e:
+            # Valid JSON in a shape we don't model; ack it, since Meta keeps
+            # redelivering anything that isn't a 200
+            log.warning("Unrecognised WhatsApp event, ignoring: %s", e)
+            return jsonify({"status": "ignored"}), 200
+        except msgspec.DecodeError as e:
+            log.error("❌ Invalid WhatsApp event: %s", e)
+            return jsonify({"status": "error", "message": str(e)}), 400
 
-        # Process WhatsApp messages asynchronously
-        try:
-            for entry in data.get('entry', []):
-                for change in entry.get('changes', []):
-                    value = change.get('value', {})
+        # Delivery/read receipts outnumber user messages; ack them without
+        # forwarding to Botpress or dispatching any work. Other events without
+        # messages (account, template updates) are still forwarded.
+        changes = [change for entry in event.entry for change in entry.changes]
+        if changes and all(change.value.statuses and not change.value.messages for change in changes):
+            return jsonify({"status": "ignored"}), 200
+
+        log.info("📩 Received WhatsApp event: %d entries, %d bytes", len(event.entry), len(raw))
 
-                    # Skip delivery/status updates
-                    if 'statuses' in value:
-                        continue
+        # Ack WhatsApp immediately; forwarding and dispatch happen on a worker
+        executor.submit(process_whatsapp_event, event, raw)
+        return jsonify({"status": "accepted"}), 200
 
-                    # Process messages
-                    for message in value.get('messages', []):
-                        phone_number = message['from']
-                        msg_type = message['type']
+def process_whatsapp_event(event, raw):
+    # Forward raw payload to Botpress webhook in parallel with message dispatch
+    executor.submit(forward_to_botpress, raw)
 
-                        if msg_type == 'text':
-                            text_content = message['text']['body']
-                            executor.submit(send_to_botpress, phone_number, text_content)
+    # Process WhatsApp messages asynchronously
+    try:
+        for entry in event.entry:
+            for change in entry.changes:
+                value = change.value
 
-                        elif msg_type == 'audio':
-                            audio_id = message['audio']['id']
-                            send_whatsapp_message(phone_number, "🎤 I received your voice message! Processing...")
-                            executor.submit(process_voice_message_async, phone_number, audio_id)
+                # Skip delivery/status updates
+                if value.statuses:
+                    continue
 
-                        else:
-                            print(f"Unhandled message type: {msg_type}")
+                # Process messages
+                for message in value.messages:
+                    MESSAGE_HANDLERS.get(message.type, handle_unknown_message)(message.from_, message)
 
-        except Exception as e:
-            print(f"❌ Error processing messages: {e}")
+    except Exception as e:
+        log.error("❌ Error processing messages: %s", e)
 
-        return jsonify({"status": "success"}), 200
+def handle_text_message(phone_number, message):
+    executor.submit(send_to_botpress, phone_number, message.text.body)
+
+def handle_audio_message(phone_number, message):
+    audio_id = message.audio.id
+    # A redelivered webhook must not download/transcribe/forward the same note twice
+    with inflight_audio_lock:
+        if audio_id in inflight_audio_ids:
+            log.info("Voice message %s already in progress, skipping duplicate", audio_id)
+            return
+        inflight_audio_ids.add(audio_id)
+    # Ack and download run concurrently rather than back-to-back
+    executor.submit(send_whatsapp_message, phone_number, VOICE_ACK_TEXT)
+    media_executor.submit(process_voice_message_async, phone_number, audio_id)
+
+def handle_unknown_message(phone_number, message):
+    log.info("Unhandled message type: %s", message.type)
+
+# Dispatch by WhatsApp message type; add new types here
+MESSAGE_HANDLERS = {
+    'text': handle_text_message,
+    'audio': handle_audio_message,
+}
 
 # -------------------
 # Botpress → Middleware → WhatsApp
@@ -92,115 +339,228 @@ def webhook():
 @app.route('/botpress-webhook', methods=['POST'])
 def botpress_webhook():
     try:
-        data = request.get_json()
-        print(f"📩 Botpress webhook data: {json.dumps(data, indent=2)}")
+        data = orjson.loads(request.get_data(cache=False))
+        log.debug("📩 Botpress webhook data: %s", LazyJSON(data))
 
         conversation_id = data.get('conversationId')
         message_type = data.get('type')
         bot_message = data.get('payload', {}).get('text', '')
+        log.info("📩 Botpress webhook: type=%s conversation=%s", message_type, conversation_id)
 
         if message_type == 'text' and conversation_id and bot_message:
-            send_whatsapp_message(conversation_id, bot_message)
-            print(f"➡ Sent to WhatsApp ({conversation_id}): {bot_message}")
+            # Ack Botpress immediately; a send retrying with backoff would
+            # outlast its timeout and trigger a duplicate redelivery
+            executor.submit(send_whatsapp_message, conversation_id, bot_message)
+            log.info("➡ Queued for WhatsApp (%s): %s", conversation_id, bot_message)
 
         return jsonify({"status": "success"}), 200
 
     except Exception as e:
-        print(f"❌ Error in Botpress webhook: {e}")
+        log.error("❌ Error in Botpress webhook: %s", e)
         return jsonify({"status": "error", "message": str(e)}), 500
 
 # -------------------
 # Utilities
 # -------------------
+def post_with_backoff(session, url, max_attempts=4, base_delay=0.5, max_delay=8.0, **kwargs):
+    # urllib3's Retry skips status retries for POSTs, so 429/5xx sends are retried
+    # here with capped exponential backoff + jitter, or after Retry-After: at most
+    # 3 sleeps of up to max_delay, ~24 s, on top of the per-request timeouts.
+    # A Retry-After beyond max_delay returns the response rather than retrying early.
+    # Connect errors are left to the session's Retry, which already covers POST;
+    # read timeouts aren't retried since the message may already have landed.
+    for attempt in range(max_attempts):
+        response = session.post(url, **kwargs)
+        if attempt == max_attempts - 1 or (response.status_code != 429 and response.status_code < 500):
+            return response
+        try:
+            delay = max(0.0, float(response.headers.get("Retry-After", "")))
+        except ValueError:
+            delay = min(max_delay, base_delay * 2 ** attempt + random.uniform(0, base_delay))
+        if delay > max_delay:
+            return response
+        time.sleep(delay)
+
 def send_whatsapp_message(phone_number, message):
     try:
-        url = f"https://graph.facebook.com/v18.0/{WHATSAPP_PHONE_NUMBER_ID}/messages"
-        payload = {
-            "messaging_product": "whatsapp",
-            "recipient_type": "individual",
-            "to": phone_number,
-            "type": "text",
-            "text": {"body": message}
-        }
-        headers = {"Authorization": f"Bearer {WHATSAPP_TOKEN}", "Content-Type": "application/json"}
-        response = requests.post(url, json=payload, headers=headers, timeout=10)
+        payload = json_encoder.encode(OutboundTextMessage(to=phone_number, text=Text(body=message)))
+        response = post_with_backoff(wa_session, WHATSAPP_MESSAGES_URL, data=payload, headers=JSON_HEADERS, timeout=10)
         if response.status_code == 200:
             return True
         else:
-            print(f"❌ WhatsApp send error {response.status_code}: {response.text}")
+            log.error("❌ WhatsApp send error %s: %s", response.status_code, response.text)
             return False
     except Exception as e:
-        print(f"❌ Error sending WhatsApp message: {e}")
+        log.error("❌ Error sending WhatsApp message: %s", e)
+        return False
+
+def forward_to_botpress(raw):
+    try:
+        # Pass the original request bytes through rather than re-encoding them
+        bp_response = bp_session.post(BOTPRESS_WEBHOOK_URL, data=raw, headers=BOTPRESS_WEBHOOK_HEADERS, timeout=5)
+        log.info("➡ Forwarded to Botpress, status: %s", bp_response.status_code)
+        return True
+    except Exception as e:
+        log.error("❌ Error forwarding to Botpress: %s", e)
         return False
 
+def warm_connection_pool():
+    # Open a pooled connection to each upstream so the first real call skips DNS + TLS
+    upstreams = (
+        (wa_session, "https://graph.facebook.com"),
+        (bp_session, "https://messaging.botpress.cloud"),
+        (bp_session, BOTPRESS_WEBHOOK_URL),
+    )
+    for session, url in upstreams:
+        if not url:
+            continue
+        try:
+            session.head(url, headers=NO_AUTH_HEADERS, timeout=5)
+        except Exception as e:
+            log.warning("Could not pre-connect to %s: %s", url, e)
+
 def send_to_botpress(user_id, message_text):
     try:
-        conversation_url = f"https://messaging.botpress.cloud/{BOTPRESS_BOT_ID}/conversations/{user_id}/messages"
-        headers = {"Content-Type": "application/json", "Authorization": f"Bearer {BOTPRESS_TOKEN}"}
+        conversation_url = f"{BOTPRESS_CONVERSATIONS_URL}/{user_id}/messages"
         payload = {"type": "text", "payload": {"text": message_text}}
-        response = requests.post(conversation_url, json=payload, headers=headers, timeout=10)
+        response = post_with_backoff(bp_session, conversation_url, json=payload, timeout=10)
         if response.status_code in [200, 201]:
-            print(f"➡ Sent to Botpress ({user_id}): {message_text}")
+            log.info("➡ Sent to Botpress (%s): %s", user_id, message_text)
             return True
         else:
-            print(f"❌ Botpress send error {response.status_code}: {response.text}")
+            log.error("❌ Botpress send error %s: %s", response.status_code, response.text)
             return False
     except Exception as e:
-        print(f"❌ Error sending to Botpress: {e}")
+        log.error("❌ Error sending to Botpress: %s", e)
         return False
 
+def resolve_media_url(media_id):
+    with media_url_cache_lock:
+        media_url = media_url_cache.get(media_id)
+    if media_url is not None:
+        return media_url, True
+    media_url = wa_session.get(f"{GRAPH_API_URL}/{media_id}", timeout=10).json()['url']
+    with media_url_cache_lock:
+        media_url_cache[media_id] = media_url
+    return media_url, False
+
 def download_whatsapp_media(media_id):
     try:
-        url = f"https://graph.facebook.com/v18.0/{media_id}"
-        headers = {"Authorization": f"Bearer {WHATSAPP_TOKEN}"}
-        media_info = requests.get(url, headers=headers, timeout=10).json()
-        media_response = requests.get(media_info['url'], headers=headers, timeout=15)
-        return media_response.content
+        media_url, from_cache = resolve_media_url(media_id)
+        r = wa_session.get(media_url, stream=True, timeout=15)
+        if r.status_code in (403, 404) and from_cache:
+            # Cached signed URL has gone stale; resolve it once more
+            r.close()
+            with media_url_cache_lock:
+                media_url_cache.pop(media_id, None)
+            media_url, _ = resolve_media_url(media_id)
+            r = wa_session.get(media_url, stream=True, timeout=15)
+        with r:
+            r.raise_for_status()
+            # Buffer in memory (voice notes are small), hashing as we go for the transcript cache
+            digest = hashlib.blake2b(digest_size=16)
+            audio = io.BytesIO()
+            for chunk in r.iter_content(chunk_size=64 * 1024):
+                audio.write(chunk)
+                digest.update(chunk)
+        audio.seek(0)
+        return audio, digest.digest()
     except Exception as e:
-        print(f"❌ Error downloading media: {e}")
-        return None
-
-def convert_voice_to_text(audio_content):
-    temp_ogg = tempfile.NamedTemporaryFile(delete=False, suffix='.ogg')
-    temp_ogg.write(audio_content)
-    temp_ogg.close()
-    temp_wav_path = temp_ogg.name.replace('.ogg', '.wav')
-    AudioSegment.from_ogg(temp_ogg.name).export(temp_wav_path, format="wav")
-    with sr.AudioFile(temp_wav_path) as source:
-        recognizer.adjust_for_ambient_noise(source, duration=0.5)
-        audio_data = recognizer.record(source)
-        try:
-            return recognizer.recognize_google(audio_data, language='en-US')
-        except sr.UnknownValueError:
-            return "Sorry, I couldn't understand the audio."
-        except sr.RequestError:
-            return "Sorry, voice recognition service is unavailable."
-        finally:
-            os.unlink(temp_ogg.name)
-            os.unlink(temp_wav_path)
+        log.error("❌ Error downloading media: %s", e)
+        return None, None
 
 def process_voice_message_async(phone_number, audio_id):
-    audio_content = download_whatsapp_media(audio_id)
-    if not audio_content:
-        send_whatsapp_message(phone_number, "❌ Could not download your voice message.")
+    handed_off = False
+    try:
+        # Stage 1 (network in): runs on the media executor
+        audio, audio_hash = download_whatsapp_media(audio_id)
+        if audio is None:
+            send_whatsapp_message(phone_number, "❌ Could not download your voice message.")
+            return
+        with transcript_cache_lock:
+            cached_text = transcript_cache.get(audio_hash)
+        if cached_text is not None:
+            send_to_botpress(phone_number, cached_text)
+            return
+        global stt_pending
+        with stt_pending_lock:
+            accepted = stt_pending < STT_MAX_QUEUE
+            if accepted:
+                stt_pending += 1
+        if not accepted:
+            send_whatsapp_message(phone_number, STT_BUSY_TEXT)
+            return
+        # Stage 2 (CPU): hand off to the STT executor so this I/O worker is freed
+        try:
+            future = submit_stt(stt.convert_voice_to_text, audio)
+        except Exception as e:
+            with stt_pending_lock:
+                stt_pending -= 1
+            log.error("❌ Could not queue voice message for STT: %s", e)
+            send_whatsapp_message(phone_number, STT_UNAVAILABLE_TEXT)
+            return
+        handed_off = True
+        future.add_done_callback(lambda f: on_voice_transcribed(phone_number, audio_id, audio_hash, f))
+    finally:
+        if not handed_off:
+            release_inflight_audio(audio_id)
+
+def on_voice_transcribed(phone_number, audio_id, audio_hash, future):
+    global stt_pending
+    with stt_pending_lock:
+        stt_pending -= 1
+    try:
+        text = future.result()
+    except Exception as e:
+        # Same as a failed hand-off: tell the user, don't forward to Botpress
+        log.error("❌ STT worker failed: %s", e)
+        release_inflight_audio(audio_id)
+        executor.submit(send_whatsapp_message, phone_number, STT_UNAVAILABLE_TEXT)
         return
-    text = convert_voice_to_text(audio_content)
-    send_to_botpress(phone_number, text)
+    with transcript_cache_lock:
+        transcript_cache[audio_hash] = text
+    release_inflight_audio(audio_id)
+    # Stage 3 (network out): back on the I/O executor
+    executor.submit(send_to_botpress, phone_number, text)
+
+def release_inflight_audio(audio_id):
+    with inflight_audio_lock:
+        inflight_audio_ids.discard(audio_id)
 
 # -------------------
 # Health & Test Endpoints
 # -------------------
 @app.route('/health', methods=['GET'])
 def health_check():
-    return jsonify({"status": "healthy", "timestamp": time.time()}), 200
+    # A broken pool is rebuilt on the next voice note; until then report it
+    return jsonify({
+        "status": "healthy" if stt_pool_ok else "degraded",
+        "timestamp": time.time(),
+        "stt_queue_depth": stt_pending,
+        "stt_pool_ok": stt_pool_ok,
+    }), 200
 
 @app.route('/test', methods=['GET'])
 def test_endpoint():
     return jsonify({"message": "Middleware running"}), 200
 
+# -------------------
+# Startup
+# -------------------
+# Not run at import time: spawned STT workers re-import this module, and
+# starting processes from there fails. Called from gunicorn's post_worker_init
+# hook (see gunicorn.conf.py) and from __main__ below.
+def start_background_services():
+    # Start the STT workers (model load + warm-up) now rather than on the first voice note
+    for _ in range(STT_WORKERS):
+        submit_stt(int)
+    executor.submit(warm_connection_pool)
+
 # -------------------
 # Run
 # -------------------
+# Local development only; in production run under gunicorn (see gunicorn.conf.py)
 if __name__ == '__main__':
-    print("🚀 WhatsApp Middleware running...")
+    start_background_services()
+    log.info("🚀 WhatsApp Middleware running...")
     app.run(host='0.0.0.0', port=int(os.getenv('PORT', 5000)), debug=False)
\ No newline at end of file
@@ -0,0 +1,47 @@
+import numpy as np
+from faster_whisper import BatchedInferencePipeline, WhisperModel, decode_audio
+
+# Runs inside the STT worker processes. Kept apart from middleware so a spawned
+# worker imports only the model code, not the Flask app, sessions and pools.
+# Each worker loads its own model in init_stt_worker.
+model = None
+batched_model = None
+batch_size = None
+chunk_seconds = None
+
+def init_stt_worker(model_name, compute_type, cpu_threads, batch, chunk):
+    global model, batched_model, batch_size, chunk_seconds
+    model = WhisperModel(
+        model_name,
+        device="cpu",
+        compute_type=compute_type,
+        cpu_threads=cpu_threads,
+        num_workers=1,
+    )
+    # Runs the VAD-split windows of a voice note through the model in batches
+    batched_model = BatchedInferencePipeline(model=model)
+    batch_size = batch
+    chunk_seconds = chunk
+
+    # One-off warm-up: loads the VAD model and runs the encoder/decoder once
+    # so the first voice note doesn't pay for lazy initialisation
+    silence = np.zeros(16000, dtype=np.float32)
+    list(model.transcribe(silence, language="en", beam_size=1)[0])
+    list(batched_model.transcribe(silence, language="en", beam_size=1, vad_filter=True)[0])
+
+# Errors propagate through the future to middleware.on_voice_transcribed
+def convert_voice_to_text(audio):
+    # Decode Opus in-process with PyAV straight to 16 kHz mono float32 PCM
+    pcm = decode_audio(audio, sampling_rate=16000)
+    # VAD splits on silences into chunks of at most chunk_seconds,
+    # which are then decoded together in batches
+    segments, _ = batched_model.transcribe(
+        pcm,
+        language="en",
+        beam_size=1,
+        vad_filter=True,
+        chunk_length=chunk_seconds,
+        batch_size=batch_size,
+    )
+    text = "".join(segment.text for segment in segments).strip()
+    return text or "Sorry, I couldn't understand the audio."